@@ -1,11 +1,13 @@
 from __future__ import annotations
-import os, asyncio, logging, contextlib, sqlite3, re
-from collections import deque
+import os, asyncio, logging, contextlib, sqlite3, re, time, threading, unicodedata, heapq
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from urllib.parse import urlparse
 
 import random
 import discord
+from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
 import yt_dlp
@@ -15,16 +17,17 @@ load_dotenv()
 PREFIX           = "h."
 BOT_TOKENS       = [t.strip() for t in os.getenv("BOT_TOKENS", "").split(',') if t.strip()]
 CLUSTER_ID       = int(os.getenv("CLUSTER_ID", "0"))
+CLUSTER_IDS      = [int(c) for c in os.getenv("CLUSTER_IDS", str(CLUSTER_ID)).split(',') if c.strip()]  # clusters hosted by this process
 TOTAL_CLUSTERS   = int(os.getenv("TOTAL_CLUSTERS", "1"))
+EXTRACT_WORKERS  = int(os.getenv("EXTRACT_WORKERS", "8"))
 
 if not BOT_TOKENS: raise SystemExit("❌  Chưa thiết lập BOT_TOKENS")
-if CLUSTER_ID >= len(BOT_TOKENS): raise SystemExit("❌  CLUSTER_ID vượt quá số token")
-TOKEN = BOT_TOKENS[CLUSTER_ID]
+if not CLUSTER_IDS or max(CLUSTER_IDS) >= len(BOT_TOKENS): raise SystemExit("❌  CLUSTER_ID vượt quá số token")
 
 # ╭─ LOG ─╮
 logging.basicConfig(level=logging.INFO,
     format="%(asctime)s | %(levelname)-8s | %(name)s | %(message)s", datefmt="%H:%M:%S")
-log = logging.getLogger(f"cluster-{CLUSTER_ID}")
+log = logging.getLogger(f"cluster-{','.join(map(str, CLUSTER_IDS))}")
 
 # ╭─ DB Owner ─╮
 conn = sqlite3.connect("bot.db", check_same_thread=False)
@@ -35,6 +38,14 @@ def set_owner(cid:int, uid:int):   conn.execute("REPLACE INTO owners VALUES (?,?
 def get_owner(cid:int)->int|None:  r=conn.execute("SELECT owner_id FROM owners WHERE channel_id=?", (cid,)).fetchone(); return r[0] if r else None
 def clear_owner(cid:int):          conn.execute("DELETE FROM owners WHERE channel_id=?", (cid,))
 
+# ╭─ DB Loudness ─╮
+with conn:
+    conn.execute("""CREATE TABLE IF NOT EXISTS loudness
+                    (track_id TEXT PRIMARY KEY, lufs REAL NOT NULL, peak REAL);""")
+def get_loudness(tid:str)->tuple[float,float|None]|None: return conn.execute("SELECT lufs, peak FROM loudness WHERE track_id=?", (tid,)).fetchone()
+def set_loudness(tid:str, lufs:float, peak:float|None):
+    with conn: conn.execute("REPLACE INTO loudness (track_id, lufs, peak) VALUES (?,?,?)", (tid, lufs, peak))
+
 # ╭─ yt-dlp & FFmpeg ─╮
 YTDL = yt_dlp.YoutubeDL({
     "format": "bestaudio/best",
@@ -277,52 +288,395 @@ def _blocking_fetch(q: str):
     
     return []
 
-async def fetch_info(q:str): 
-    result = await asyncio.get_running_loop().run_in_executor(None, _blocking_fetch, q)
-    return result if isinstance(result, list) else [result] if result else []
+# Shared by every client in the process
+extract_pool = ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix="extract")
+FETCH_CACHE_TTL = 300
+FETCH_CACHE_MAX = 512
+_fetch_cache:dict[str,tuple[float,list]]={}
+_fetch_inflight:dict[str,asyncio.Task]={}
+
+async def _fetch_uncached(q:str):
+    result = await asyncio.get_running_loop().run_in_executor(extract_pool, _blocking_fetch, q)
+    result = result if isinstance(result, list) else [result] if result else []
+    if result:
+        _fetch_cache[q] = (time.monotonic(), result)
+        while len(_fetch_cache) > FETCH_CACHE_MAX: _fetch_cache.pop(next(iter(_fetch_cache)))
+    return result
+
+async def fetch_info(q:str):
+    """Resolve a query, sharing recent results and in-flight lookups between clients"""
+    hit = _fetch_cache.get(q)
+    if hit and time.monotonic() - hit[0] < FETCH_CACHE_TTL:
+        result = hit[1]
+    else:
+        task = _fetch_inflight.get(q)
+        if task is None:
+            task = _fetch_inflight[q] = asyncio.ensure_future(_fetch_uncached(q))
+            task.add_done_callback(lambda _: _fetch_inflight.pop(q, None))
+        result = await asyncio.shield(task)
+    # Callers mutate and queue these dicts, so each gets its own copy
+    return [dict(t) for t in result]
+
+# ╭─ Stall watchdog ─╮
+FRAME_BYTES         = 3840   # 20ms of 48kHz stereo s16le, what FFmpegPCMAudio.read() returns
+FRAME_SECONDS       = 0.02
+SILENCE_FRAME       = b"\x00" * FRAME_BYTES
+STALL_TIMEOUT       = 15     # seconds without a frame before FFmpeg is considered stalled
+STALL_EOF_TOLERANCE = 5      # EOF this many seconds before the known duration counts as early
+STALL_MAX_RETRIES   = 3
+STALL_STABLE_SECONDS= 60     # clean playback after a recovery before the retry budget is restored
+stall_stats:dict[str,dict[str,int]]={}
+
+def _count_stall(platform: str, outcome: str):
+    stats = stall_stats.setdefault(platform, {"recovered": 0, "failed": 0})
+    stats[outcome] += 1
+
+def _resolve_stream_url(webpage_url: str) -> str|None:
+    """Re-resolve a fresh stream URL (CDN links expire)"""
+    data = YTDL.extract_info(webpage_url, download=False)
+    if data and "entries" in data:
+        data = next((e for e in data["entries"] if e), None)
+    return data.get("url") if data else None
+
+class SupervisedSource(discord.AudioSource):
+    """FFmpeg source that counts frames and restarts FFmpeg at the last position on stall/early EOF"""
+    def __init__(self, info: dict):
+        self.info = info
+        self.platform = info.get("detected_platform") or detect_platform_from_url(info.get("webpage_url", ""))
+        self.duration = int(info.get("duration") or 0)
+        self.frames = 0; self.retries = 0; self._recovered_frame = 0
+        self.stalled = False
+        self._recovering = False; self._restarting = False; self._closed = False
+        self._lock = threading.Lock()  # guards _src swaps against cleanup() from the player thread
+        self.resync = None  # set by the owner; resets the AudioPlayer frame clock
+        self._src = self._spawn(info["url"], 0)
+        self.last_frame = time.monotonic()
+
+    @property
+    def position(self) -> float:
+        return self.frames * FRAME_SECONDS
+
+    def _spawn(self, url: str, pos: float):
+        before = FFMPEG_OPTS["before_options"] + (f" -ss {pos:.2f}" if pos else "")
+        playback_stats["ffmpeg_spawns"] += 1
+        return discord.FFmpegPCMAudio(url, before_options=before, options=FFMPEG_OPTS["options"])
+
+    def _needs_restart(self) -> bool:
+        if self.stalled or self._recovering: return True
+        return bool(self.duration) and self.position < self.duration - STALL_EOF_TOLERANCE
+
+    def _resync_clock(self):
+        # A blocked read leaves AudioPlayer far behind its schedule and it would burst frames to catch up
+        if self.resync:
+            with contextlib.suppress(Exception): self.resync()
+
+    def read(self) -> bytes:
+        # Silence while the new FFmpeg spins up, paced by the (resynced) AudioPlayer clock
+        if self._restarting:
+            if not self.resync: time.sleep(FRAME_SECONDS)
+            return SILENCE_FRAME
+        data = self._src.read()
+        if data:
+            if self._recovering:
+                self._recovering = False
+                # The first read blocked through FFmpeg's start-up and seek; resync again before real audio
+                self._resync_clock()
+                _count_stall(self.platform, "recovered")
+                log.info(f"Recovered {self.platform} stream at {self.position:.1f}s: {self.info.get('title')}")
+                self._recovered_frame = self.frames
+            self.frames += 1; self.last_frame = time.monotonic()
+            # Separate stalls on a long track each get the full retry budget
+            if self.retries and self.frames - self._recovered_frame >= STALL_STABLE_SECONDS / FRAME_SECONDS:
+                self.retries = 0
+            return data
+        if self._closed or not self._needs_restart(): return b""
+        if self.retries >= STALL_MAX_RETRIES:
+            _count_stall(self.platform, "failed")
+            log.warning(f"Giving up on {self.platform} stream at {self.position:.1f}s after {self.retries} restarts: {self.info.get('title')}")
+            return b""
+        self.retries += 1
+        self.stalled = False; self._recovering = True; self._restarting = True
+        log.warning(f"{self.platform} stream ended early at {self.position:.1f}/{self.duration}s, restarting ({self.retries}/{STALL_MAX_RETRIES})")
+        self._resync_clock()
+        extract_pool.submit(self._restart)
+        return SILENCE_FRAME
+
+    def _restart(self):
+        new = None
+        try:
+            url = self.info["url"]
+            # First retry reuses the URL; after that assume it expired
+            if self.retries > 1 and self.info.get("webpage_url"):
+                url = _resolve_stream_url(self.info["webpage_url"]) or url
+                self.info["url"] = url
+            new = self._spawn(url, self.position)
+        except Exception as e:
+            log.warning(f"Failed to restart {self.platform} stream: {e}")
+        if new is not None:
+            with self._lock:
+                if self._closed:
+                    new.cleanup()
+                else:
+                    old, self._src = self._src, new
+                    old.cleanup()
+        self.last_frame = time.monotonic()
+        self._restarting = False
+
+    def check_stall(self, now: float) -> bool:
+        """Kill a stalled FFmpeg so read() hits EOF and takes the restart path"""
+        if self._restarting or self._closed or now - self.last_frame < STALL_TIMEOUT: return False
+        self.stalled = True
+        with contextlib.suppress(Exception):
+            self._src._process.kill()
+        return True
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self):
+        with self._lock:
+            self._closed = True
+            self._src.cleanup()
+
+# ╭─ Loudness normalization ─╮
+LOUDNESS_TARGET      = -14.0  # LUFS
+LOUDNESS_MAX_GAIN_DB = 6.0    # boost cap: PCMVolumeTransformer clamps its multiplier to 2.0 (~+6 dB)
+LOUDNESS_PEAK_CEIL   = -1.0   # dBTP; boosts never push the measured true peak above this
+MAX_GAIN             = 2.0    # combined loudness x guild volume, PCMVolumeTransformer's own cap
+LOUDNESS_MAX_SECONDS = 600    # analyse at most this much of a track
+_loudness_sem = asyncio.Semaphore(2)
+_analyzing:set[str]=set()
+
+def track_id(info: dict) -> str|None:
+    """Stable id for a resolved track, e.g. 'Youtube:dQw4w9WgXcQ'"""
+    if not info.get("id"): return None
+    return f"{info.get('extractor_key') or info.get('extractor', '')}:{info['id']}"
+
+def loudness_gain(info: dict) -> float:
+    """Linear gain bringing the track to LOUDNESS_TARGET, 1.0 if not measured yet"""
+    tid = track_id(info)
+    row = get_loudness(tid) if tid else None
+    if row is None: return 1.0
+    lufs, peak = row
+    db = min(LOUDNESS_MAX_GAIN_DB, LOUDNESS_TARGET - lufs)
+    # audioop.mul has no limiter, so keep a boosted quiet track's peaks from hard-clipping
+    if peak is not None and db > 0: db = max(0.0, min(db, LOUDNESS_PEAK_CEIL - peak))
+    return 10 ** (db / 20)
+
+async def analyze_loudness(info: dict):
+    """Measure integrated loudness once with FFmpeg's loudnorm and cache it in bot.db"""
+    tid = track_id(info)
+    if not tid or tid in _analyzing or get_loudness(tid) is not None: return
+    _analyzing.add(tid)
+    try:
+        async with _loudness_sem:
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg", *FFMPEG_OPTS["before_options"].split(), "-i", info["url"],
+                "-t", str(LOUDNESS_MAX_SECONDS), "-vn", "-af", "loudnorm=print_format=json", "-f", "null", "-",
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+            _, err = await proc.communicate()
+        out = err.decode(errors="ignore")
+        m = re.search(r'"input_i"\s*:\s*"(-?[\d.]+|-inf)"', out)
+        if not m or m.group(1) == "-inf":
+            log.warning(f"Loudness analysis failed for {tid}")
+            return
+        tp = re.search(r'"input_tp"\s*:\s*"(-?[\d.]+)"', out)
+        set_loudness(tid, float(m.group(1)), float(tp.group(1)) if tp else None)
+        log.info(f"Measured {tid}: {m.group(1)} LUFS")
+    except Exception as e:
+        log.warning(f"Loudness analysis failed for {tid}: {e}")
+    finally:
+        _analyzing.discard(tid)
+
+# ╭─ Local search index ─╮
+INDEX_MAX_SIZE     = 5000
+INDEX_CONFIDENT    = 0.5           # min share of title words a query must hit to skip the remote search
+INDEX_REFRESH_AGE  = 7 * 86400     # re-extract entries older than this
+INDEX_REFRESH_BATCH= 10
+INDEX_RETRY_DELAY  = 86400         # after a transient refresh failure, try again this much later
+# yt-dlp errors meaning the track is gone for good; anything else (network, 429, bot checks) is transient
+INDEX_GONE_RE      = re.compile(r"video unavailable|private video|has been removed|been terminated|"
+                                r"does not exist|no longer available|HTTP Error 404|HTTP Error 410", re.I)
+INDEX_COLUMNS      = ("track_id","title","uploader","platform","webpage_url","duration","thumbnail","hits","last_used","refreshed")
+
+def _norm(text: str) -> str:
+    """Lowercase, strip Vietnamese diacritics and punctuation"""
+    text = unicodedata.normalize("NFKD", text.lower().replace("đ", "d"))
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.sub(r"[\W_]+", " ", text).strip()
+
+def _trigrams(text: str) -> set[str]:
+    padded = f"  {text} "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+class TrackIndex:
+    """Bounded trigram index of previously resolved tracks, persisted in bot.db"""
+    def __init__(self, db: sqlite3.Connection, max_size: int = INDEX_MAX_SIZE):
+        self.db = db; self.max_size = max_size
+        self.entries:dict[str,dict] = {}
+        self.grams:dict[str,set[str]] = {}
+        self.urls:dict[str,str] = {}
+        with db:
+            db.execute("""CREATE TABLE IF NOT EXISTS track_index
+                          (track_id TEXT PRIMARY KEY, title TEXT NOT NULL, uploader TEXT, platform TEXT,
+                           webpage_url TEXT NOT NULL, duration INTEGER, thumbnail TEXT,
+                           hits INTEGER NOT NULL, last_used REAL NOT NULL, refreshed REAL NOT NULL);""")
+        for row in db.execute(f"SELECT {','.join(INDEX_COLUMNS)} FROM track_index"):
+            self._insert(dict(zip(INDEX_COLUMNS, row)))
+        with db: self._evict_overflow()
+
+    def _insert(self, e: dict):
+        text = _norm(f"{e['title']} {e['uploader'] or ''}")
+        e["_tokens"] = set(text.split()); e["_grams"] = _trigrams(text)
+        self.entries[e["track_id"]] = e
+        self.urls[e["webpage_url"]] = e["track_id"]
+        for g in e["_grams"]: self.grams.setdefault(g, set()).add(e["track_id"])
+
+    def _drop(self, tid: str):
+        e = self.entries.pop(tid, None)
+        if not e: return
+        self.urls.pop(e["webpage_url"], None)
+        for g in e["_grams"]:
+            ids = self.grams.get(g)
+            if ids is not None:
+                ids.discard(tid)
+                if not ids: del self.grams[g]
+
+    def _save(self, e: dict):
+        with self.db:
+            self.db.execute(f"REPLACE INTO track_index VALUES ({','.join('?'*len(INDEX_COLUMNS))})",
+                            tuple(e[c] for c in INDEX_COLUMNS))
+
+    def _evict_overflow(self):
+        """Drop least recently used entries past max_size; caller owns the transaction"""
+        over = len(self.entries) - self.max_size
+        if over <= 0: return
+        old = heapq.nsmallest(over, self.entries, key=lambda t: self.entries[t]["last_used"])
+        for tid in old: self._drop(tid)
+        self.db.executemany("DELETE FROM track_index WHERE track_id=?", [(tid,) for tid in old])
+
+    def remove(self, tid: str):
+        self._drop(tid)
+        with self.db: self.db.execute("DELETE FROM track_index WHERE track_id=?", (tid,))
+
+    def add(self, info: dict):
+        self.add_many([info])
+
+    def add_many(self, infos: list[dict]):
+        """Record resolved tracks (or bump known ones) in a single transaction"""
+        now = time.time(); changed = {}
+        for info in infos:
+            tid = track_id(info); url = info.get("webpage_url")
+            if not tid or not url or not info.get("title"): continue
+            old = self.entries.get(tid)
+            self._drop(tid)
+            e = {"track_id": tid, "title": info["title"], "uploader": info.get("uploader"),
+                 "platform": detect_platform_from_url(url), "webpage_url": url,
+                 "duration": int(info.get("duration") or 0), "thumbnail": info.get("thumbnail"),
+                 "hits": old["hits"] + 1 if old else 1, "last_used": now,
+                 "refreshed": old["refreshed"] if old else now}
+            self._insert(e); changed[tid] = e
+        if not changed: return
+        with self.db:
+            self.db.executemany(f"REPLACE INTO track_index VALUES ({','.join('?'*len(INDEX_COLUMNS))})",
+                                [tuple(e[c] for c in INDEX_COLUMNS) for e in changed.values()])
+            self._evict_overflow()
+
+    def search(self, query: str, limit: int = 25) -> list[tuple[float,dict]]:
+        q = _norm(query)
+        if not q: return []
+        qg = _trigrams(q); counts = Counter()
+        for g in qg: counts.update(self.grams.get(g, ()))
+        results = []
+        for tid, c in counts.items():
+            e = self.entries[tid]
+            score = 0.7 * c / len(qg) + 0.3 * 2 * c / (len(qg) + len(e["_grams"])) + min(e["hits"], 50) / 1000
+            if score >= 0.3: results.append((score, e))
+        results.sort(key=lambda r: r[0], reverse=True)
+        return results[:limit]
+
+    def lookup(self, query: str) -> dict|None:
+        """Confident local hit for a play query, as a queueable info dict"""
+        query = query.strip()
+        if query in self.urls: return self.as_info(self.entries[self.urls[query]])
+        if query.startswith(("http://", "https://")): return None
+        platform, term = parse_query(query)
+        q = _norm(term); tokens = set(q.split())
+        if not tokens: return None
+        full = [e for _, e in self.search(term)
+                if tokens <= e["_tokens"] and (term == query or e["platform"] == platform)]
+        # Several known tracks match (e.g. two songs called "Hello"): let the remote search decide
+        if len(full) != 1: return None
+        e = full[0]
+        title = set(_norm(e["title"]).split())
+        if title and len(tokens & title) / len(title) >= INDEX_CONFIDENT: return self.as_info(e)
+        # Several title words matching exactly one known track is also good enough;
+        # uploader-only queries ("rick astley") still go to the remote search
+        if len(tokens & title) >= 2: return self.as_info(e)
+        return None
+
+    def stale(self, limit: int = INDEX_REFRESH_BATCH) -> list[dict]:
+        cutoff = time.time() - INDEX_REFRESH_AGE
+        old = [e for e in self.entries.values() if e["refreshed"] < cutoff]
+        return sorted(old, key=lambda e: e["hits"], reverse=True)[:limit]
+
+    def postpone(self, tid: str):
+        """Push a failed refresh back by INDEX_RETRY_DELAY instead of dropping the entry"""
+        e = self.entries.get(tid)
+        if not e: return
+        e["refreshed"] = time.time() - INDEX_REFRESH_AGE + INDEX_RETRY_DELAY
+        self._save(e)
+
+    def refresh(self, tid: str, info: dict):
+        e = self.entries.get(tid)
+        if not e: return
+        self._drop(tid)
+        e.update(title=info.get("title") or e["title"], uploader=info.get("uploader") or e["uploader"],
+                 duration=int(info.get("duration") or e["duration"] or 0),
+                 thumbnail=info.get("thumbnail") or e["thumbnail"], refreshed=time.time())
+        self._insert(e); self._save(e)
+
+    @staticmethod
+    def as_info(e: dict) -> dict:
+        extractor, _, vid = e["track_id"].partition(":")
+        return {"id": vid, "extractor_key": extractor, "title": e["title"], "uploader": e["uploader"],
+                "webpage_url": e["webpage_url"], "duration": e["duration"], "thumbnail": e["thumbnail"],
+                "detected_platform": e["platform"]}
+
+track_index = TrackIndex(conn)
 
 # ╭─ STATE ─╮
-queues:dict[int,deque]={}
-history:dict[int,deque]={}
-now_playing:dict[int,dict]={}
-last_use:dict[int,datetime]={}
-idle_timers:dict[int,asyncio.Task]={}
-loops:dict[int,bool]={}
+# Playback state dicts live on each MyBot so several clients can share a process
 IDLE_TIMEOUT=60  # 1 minute of no music playing
 VOICE_TIMEOUT=1800  # 30 minutes of no activity
 
 def _key(ctx): return ctx.author.voice.channel.id if ctx.author.voice else ctx.guild.id
-def _queue(k): return queues.setdefault(k,deque())
-def _history(k): return history.setdefault(k,deque(maxlen=20))
+def _queue(bot,k): return bot.queues.setdefault(k,deque())
+def _history(bot,k): return bot.history.setdefault(k,deque(maxlen=20))
+def _gain(bot, guild_id:int, info:dict)->float: return min(MAX_GAIN, bot.volumes.get(guild_id,1.0)*loudness_gain(info))
 
 # ╭─ Auto-disconnect when idle ─╮
-async def idle_disconnect(key: int, delay: int = IDLE_TIMEOUT):
+async def idle_disconnect(bot, key: int, delay: int = IDLE_TIMEOUT):
     await asyncio.sleep(delay)
     vc = discord.utils.get(bot.voice_clients, channel__id=key)
+    bot.idle_timers.pop(key, None)
     if vc and not vc.is_playing() and not vc.is_paused():
-        try:
-            await vc.disconnect(force=True)
-            queues.pop(key, None)
-            history.pop(key, None)
-            now_playing.pop(key, None)
-            last_use.pop(key, None)
-            clear_owner(key)
-            log.info(f"Auto-disconnected from channel {key} due to inactivity")
-        except:
-            pass
-    idle_timers.pop(key, None)
+        p = bot.players.get(key)
+        if p: p.send("leave")
+        else: await _leave_channel(bot, key, vc)
+        bot.log.info(f"Auto-disconnected from channel {key} due to inactivity")
 
-def start_idle_timer(key: int):
+def start_idle_timer(bot, key: int):
     # Cancel existing timer
-    if key in idle_timers:
-        idle_timers[key].cancel()
+    if key in bot.idle_timers:
+        bot.idle_timers[key].cancel()
     # Start new timer
-    idle_timers[key] = bot.loop.create_task(idle_disconnect(key))
+    bot.idle_timers[key] = bot.loop.create_task(idle_disconnect(bot, key))
 
-def cancel_idle_timer(key: int):
-    if key in idle_timers:
-        idle_timers[key].cancel()
-        idle_timers.pop(key, None)
+def cancel_idle_timer(bot, key: int):
+    if key in bot.idle_timers:
+        bot.idle_timers[key].cancel()
+        bot.idle_timers.pop(key, None)
 
 # ╭─ Queue Pagination ─╮
 class QueueView(discord.ui.View):
@@ -381,63 +735,54 @@ class QueueView(discord.ui.View):
 
 # ╭─ Discord UI Buttons ─╮
 class MusicControls(discord.ui.View):
-    def __init__(self, key:int, *, timeout:float|None=1800, persistent=False):
+    def __init__(self, bot, key:int, *, timeout:float|None=1800, persistent=False):
         super().__init__(timeout=None if persistent else timeout)
-        self.key=key; self.paused=False; self.loop=loops.get(key, False)
+        self.bot=bot; self.key=key; self.paused=False; self.loop=bot.loops.get(key, False)
         if self.loop:
             self.loop_btn.style = discord.ButtonStyle.success
 
     @discord.ui.button(label="⏸️", style=discord.ButtonStyle.secondary, custom_id="btn_pause")
     async def pause_btn(self, intr:discord.Interaction, btn:discord.ui.Button):
-        vc=intr.guild.voice_client
-        if not vc: return await intr.response.defer()
+        # Respond before touching the player: its mailbox may be busy past the 3s interaction deadline
+        p=self.bot.players.get(self.key)
+        if not p: return await intr.response.defer()
         if self.paused: 
-            vc.resume(); btn.label="⏸️"
-            cancel_idle_timer(self.key)
+            p.send("resume"); btn.label="⏸️"
         else: 
-            vc.pause(); btn.label="▶️"
-            start_idle_timer(self.key)
+            p.send("pause"); btn.label="▶️"
         self.paused=not self.paused
         await intr.response.edit_message(view=self)
 
     @discord.ui.button(label="⏮️", style=discord.ButtonStyle.secondary, custom_id="btn_prev")
     async def prev_btn(self, intr, _):
-        hist=_history(self.key)
-        if not hist: return await intr.response.defer()
-        _queue(self.key).appendleft(hist.pop())
-        intr.guild.voice_client.stop(); await intr.response.defer()
+        p=self.bot.players.get(self.key)
+        if p: p.send("previous")
+        await intr.response.defer()
 
     @discord.ui.button(label="⏭️", style=discord.ButtonStyle.secondary, custom_id="btn_skip")
     async def skip_btn(self, intr,_):
-        intr.guild.voice_client and intr.guild.voice_client.stop()
+        p=self.bot.players.get(self.key)
+        if p: p.send("skip")
         await intr.response.defer()
 
     @discord.ui.button(label="🔀", style=discord.ButtonStyle.secondary, custom_id="btn_shuffle")
     async def shuffle_btn(self, intr,_):
-        q=list(_queue(self.key))
-        if len(q)<2:
-            await intr.response.send_message("❌ Hàng chờ không đủ bài để trộn.", ephemeral=True)
+        await intr.response.defer()
+        if not await _call(self.bot, self.key, "shuffle"):
+            await intr.followup.send("❌ Hàng chờ không đủ bài để trộn.", ephemeral=True)
             return
-        random.shuffle(q); queues[self.key]=deque(q)
-        await intr.response.send_message("🔀 Đã trộn hàng chờ.", ephemeral=True)
+        await intr.followup.send("🔀 Đã trộn hàng chờ.", ephemeral=True)
 
     @discord.ui.button(label="⏹️", style=discord.ButtonStyle.danger, custom_id="btn_stop")
     async def stop_btn(self, intr,_):
+        await intr.response.defer()
         vc = intr.guild.voice_client
         if vc:
-            await vc.disconnect(force=True)
-            key = self.key
-            queues.pop(key, None)
-            history.pop(key, None)
-            now_playing.pop(key, None)
-            last_use.pop(key, None)
-            cancel_idle_timer(key)
-            clear_owner(key)
-        await intr.response.defer()
+            await _leave(self.bot, self.key, vc)
 
     @discord.ui.button(label="📋", style=discord.ButtonStyle.secondary, custom_id="btn_queue")
     async def queue_btn(self, intr,_):
-        q=list(_queue(self.key))
+        q=list(_queue(self.bot, self.key))
         if not q:
             emb=discord.Embed(title="🎵 Hàng chờ phát nhạc", description="Hàng chờ trống", color=0x0061ff)
             await intr.response.send_message(embed=emb, ephemeral=True)
@@ -448,18 +793,37 @@ class MusicControls(discord.ui.View):
     @discord.ui.button(label="🔁", style=discord.ButtonStyle.secondary, custom_id="btn_loop")
     async def loop_btn(self, intr, btn):
         self.loop=not self.loop
-        loops[self.key]=self.loop
+        p=self.bot.players.get(self.key)
+        if p: p.send("loop", self.loop)
+        else: self.bot.loops[self.key]=self.loop
         btn.style = discord.ButtonStyle.success if self.loop else discord.ButtonStyle.secondary
         await intr.response.edit_message(view=self)
 
-# ╭─ Bot subclass (to add persistent view) ─╮
+# ╭─ Bot subclass (per-client state + persistent view) ─╮
 class MyBot(commands.Bot):
+    def __init__(self, cluster_id:int, **kwargs):
+        super().__init__(**kwargs)
+        self.cluster_id=cluster_id
+        self.queues:dict[int,deque]={}
+        self.history:dict[int,deque]={}
+        self.now_playing:dict[int,dict]={}
+        self.last_use:dict[int,datetime]={}
+        self.idle_timers:dict[int,asyncio.Task]={}
+        self.loops:dict[int,bool]={}
+        self.volumes:dict[int,float]={}  # per guild, 1.0 = 100%
+        self.players:dict[int,Player]={}
+        self.log=logging.getLogger(f"cluster-{cluster_id}")
+        if cluster_id: self.help_command=None
+
     async def setup_hook(self):
-        self.add_view(MusicControls(key=0, persistent=True))
+        await self.add_cog(Music(self))
+        self.add_view(MusicControls(self, key=0, persistent=True))
+        try:
+            await self.tree.sync()
+        except discord.HTTPException as e:
+            self.log.warning(f"Failed to sync slash commands: {e}")
 
 intents=discord.Intents.default(); intents.message_content=True; intents.guilds=True; intents.voice_states=True
-bot=MyBot(command_prefix=PREFIX, intents=intents)
-if CLUSTER_ID: bot.help_command=None
 
 # ╭─ helpers ─╮
 async def _ensure_vc(ctx):
@@ -468,7 +832,7 @@ async def _ensure_vc(ctx):
     if vc.channel != ctx.author.voice.channel: await vc.move_to(ctx.author.voice.channel)
     return vc
 
-async def _send_np(ctx, info, key):
+async def _send_np(ctx, info, key, channel=None):
     dur=int(info.get('duration',0)); m,s=divmod(dur,60)
     
     # Detect platform
@@ -487,279 +851,536 @@ async def _send_np(ctx, info, key):
             .set_thumbnail(url=info.get("thumbnail"))
             .add_field(name="⏱ Thời lượng", value=f"{m}:{s:02d}"))
     
-    queue_size = len(_queue(key))
+    queue_size = len(_queue(ctx.bot, key))
     if queue_size > 0:
         emb.add_field(name="📋 Hàng chờ", value=f"{queue_size} bài", inline=True)
     
-    await ctx.send(embed=emb, view=MusicControls(key))
+    await (channel or ctx).send(embed=emb, view=MusicControls(ctx.bot, key))
 
-async def _next(key:int, ctx):
-    q=_queue(key)
-    if not q:
-        start_idle_timer(key)
-        return
-    
-    cancel_idle_timer(key)
-    info=q.popleft(); info["url"]=info.get("url") or info["webpage_url"]
-    if loops.get(key):
-        q.append(info)
-    vc=ctx.voice_client; src=discord.FFmpegPCMAudio(info["url"],**FFMPEG_OPTS)
-    if key in now_playing: _history(key).append(now_playing[key])
-    now_playing[key]=info; last_use[key]=datetime.now(timezone.utc)
-    vc.play(src, after=lambda _:
-        ctx.bot.loop.call_soon_threadsafe(asyncio.create_task,_next(key,ctx)))
-    await _send_np(ctx, info, key)
+async def _leave_channel(bot, key:int, vc):
+    with contextlib.suppress(discord.DiscordException):
+        if vc: await vc.disconnect(force=True)
+    bot.queues.pop(key, None)
+    bot.history.pop(key, None)
+    bot.now_playing.pop(key, None)
+    bot.last_use.pop(key, None)
+    cancel_idle_timer(bot, key)
+    clear_owner(key)
+
+# ╭─ Player (one task per voice channel) ─╮
+playback_stats:dict[str,int]={"ops":0,"coalesced":0,"plays":0,"ffmpeg_spawns":0}
+PLAYER_SETTLE=0.25  # quiet period after skip/previous/track end before FFmpeg is started
+PLAYER_MAX_FAILURES=3  # consecutive tracks that fail to start before the player gives up and idles
+
+class Player:
+    """Owns a voice channel's queue and FFmpeg: ops go through a mailbox and one task applies them in order"""
+    def __init__(self, bot, key:int, ctx):
+        self.bot=bot; self.key=key; self.ctx=ctx
+        self.mailbox:asyncio.Queue=asyncio.Queue()
+        self.gen=0            # bumped on every stop so stale `after` callbacks are ignored
+        self.active=False     # a source is playing or paused
+        self.starting=False   # now_playing's stream URL is being resolved off the mailbox path
+        self.want:str|None=None  # "play" | "idle" | "leave", applied once the mailbox is drained
+        self.closed=False
+        self._settle=False    # a track change is waiting out PLAYER_SETTLE for more ops
+        self.failures=0       # consecutive start failures, see PLAYER_MAX_FAILURES
+        self._tasks:set[asyncio.Task]=set()  # resolve/loudness/now-playing tasks; the loop only holds weak refs
+        self.task=bot.loop.create_task(self._run())
+
+    def send(self, op:str, *args):
+        if not self.closed: self.mailbox.put_nowait((op, args, None))
+
+    async def call(self, op:str, *args):
+        if self.closed: return None
+        fut=self.bot.loop.create_future()
+        self.mailbox.put_nowait((op, args, fut))
+        return await fut
+
+    async def _run(self):
+        while True:
+            if self.want and not self._settle and self.mailbox.empty():
+                try:
+                    await self._apply()
+                except Exception as e:
+                    self.bot.log.error(f"Player {self.key} failed to start playback: {e}")
+                    self._failed()
+                continue
+            # Human skip/previous clicks arrive far apart; keep merging them until the channel goes quiet
+            try:
+                item=await asyncio.wait_for(self.mailbox.get(), PLAYER_SETTLE if self._settle else None)
+            except asyncio.TimeoutError:
+                self._settle=False
+                continue
+            batch=[item]
+            while not self.mailbox.empty(): batch.append(self.mailbox.get_nowait())
+            playback_stats["ops"]+=len(batch)
+            for op, args, fut in batch:
+                try:
+                    res=getattr(self, f"_op_{op}")(*args)
+                except Exception as e:
+                    self.bot.log.error(f"Player {self.key} failed on {op}: {e}")
+                    if fut and not fut.done(): fut.set_exception(e)
+                else:
+                    if fut and not fut.done(): fut.set_result(res)
+            if self.want=="leave": return await self._close()
+
+    async def _close(self):
+        self.closed=True
+        if self.bot.players.get(self.key) is self: self.bot.players.pop(self.key)
+        self._halt()
+        await _leave_channel(self.bot, self.key, self.ctx.voice_client)
+        while not self.mailbox.empty():
+            *_, fut = self.mailbox.get_nowait()
+            if fut and not fut.done(): fut.set_result(None)
+
+    async def _apply(self):
+        want, self.want = self.want, None
+        bot, key = self.bot, self.key
+        if want=="idle":
+            start_idle_timer(bot, key)
+            return
+        info=bot.now_playing.get(key); vc=self.ctx.voice_client
+        if not info: return
+        if not vc: raise RuntimeError("not connected to voice")
+        cancel_idle_timer(bot, key)
+        if not info.get("url"):  # local index hits carry only the page URL
+            # Resolve in the background so the mailbox keeps answering; "resolved" re-arms the start
+            self.starting=True
+            self._background(self._resolve(info))
+            return
+        self._halt(); gen=self.gen
+        sup=SupervisedSource(info)
+        sup.resync=lambda: vc.is_paused() or vc.resume()  # resume() resets AudioPlayer's loops/_start
+        src=discord.PCMVolumeTransformer(sup, volume=_gain(bot, self.ctx.guild.id, info))
+        vc.play(src, after=lambda err: bot.loop.call_soon_threadsafe(self.send, "finished", gen, err))
+        self.active=True; self.failures=0; playback_stats["plays"]+=1
+        self._background(analyze_loudness(info))
+        self._background(self._post_np(info))
+
+    def _background(self, coro):
+        t=self.bot.loop.create_task(coro)
+        self._tasks.add(t); t.add_done_callback(self._tasks.discard)
+
+    async def _post_np(self, info:dict):
+        # Post to the text channel: a /play ctx would reply through an interaction followup,
+        # whose token expires after 15 minutes
+        try:
+            await _send_np(self.ctx, info, self.key, channel=self.ctx.channel)
+        except Exception as e:
+            self.bot.log.warning(f"Failed to post now playing for channel {self.key}: {e}")
+
+    async def _resolve(self, info:dict):
+        url=None
+        with contextlib.suppress(Exception):
+            url=await self.bot.loop.run_in_executor(extract_pool,_resolve_stream_url,info["webpage_url"])
+        info["url"]=url or info["webpage_url"]
+        self.send("resolved", info)
+
+    @property
+    def busy(self) -> bool:
+        return self.active or self.starting or self.want=="play"
+
+    def _halt(self):
+        self.gen+=1; self.active=False; self.starting=False
+        vc=self.ctx.voice_client
+        if vc and (vc.is_playing() or vc.is_paused()): vc.stop()
+
+    def _failed(self):
+        """Drop the track that could not start and move on, idling after PLAYER_MAX_FAILURES in a row"""
+        bot, key = self.bot, self.key
+        self._halt()
+        bot.now_playing.pop(key, None)
+        self.failures+=1
+        if self.failures<PLAYER_MAX_FAILURES and self.ctx.voice_client:
+            self._advance()
+            return
+        self.failures=0; self.want=None
+        start_idle_timer(bot, key)
+
+    def _advance(self):
+        """Pop the next track into now_playing; playback restarts when the mailbox is drained"""
+        bot, key = self.bot, self.key
+        q=_queue(bot, key)
+        # The previous pick never reached FFmpeg (or its resolve is dropped): merged, not spawned
+        if self.want=="play" or self.starting: playback_stats["coalesced"]+=1
+        self._halt()
+        if not q:
+            self.want="idle"
+            return
+        info=q.popleft()
+        if bot.loops.get(key):
+            q.append(info)
+        if key in bot.now_playing: _history(bot, key).append(bot.now_playing[key])
+        bot.now_playing[key]=info; bot.last_use[key]=datetime.now(timezone.utc)
+        self.want="play"
+
+    def _op_enqueue(self, tracks:list, ctx):
+        self.ctx=ctx
+        _queue(self.bot, self.key).extend(tracks)
+        self.bot.last_use[self.key]=datetime.now(timezone.utc)
+        if not self.busy: self._advance()
+        return len(tracks)
+
+    def _op_resolved(self, info:dict):
+        # Ignore results for a track that was skipped while resolving
+        if self.starting and self.bot.now_playing.get(self.key) is info:
+            self.starting=False; self.want="play"
+
+    def _op_finished(self, gen:int, err):
+        if err: self.bot.log.error(f"Playback error in channel {self.key}: {err}")
+        if gen==self.gen: self._advance(); self._settle=True
+
+    def _op_skip(self):
+        if not self.busy: return False
+        self._advance(); self._settle=True
+        return True
+
+    def _op_previous(self):
+        hist=_history(self.bot, self.key)
+        if not hist: return False
+        _queue(self.bot, self.key).appendleft(hist.pop())
+        self._advance(); self._settle=True
+        return True
+
+    def _op_pause(self):
+        vc=self.ctx.voice_client
+        if not vc or not vc.is_playing(): return False
+        vc.pause(); start_idle_timer(self.bot, self.key)
+        return True
+
+    def _op_resume(self):
+        vc=self.ctx.voice_client
+        if not vc or not vc.is_paused(): return False
+        vc.resume(); cancel_idle_timer(self.bot, self.key)
+        return True
+
+    def _op_loop(self, state:bool|None=None):
+        bot, key = self.bot, self.key
+        bot.loops[key] = not bot.loops.get(key, False) if state is None else state
+        if bot.loops[key]:
+            current = bot.now_playing.get(key)
+            if current and current not in _queue(bot, key):
+                _queue(bot, key).appendleft(current)
+        return bot.loops[key]
+
+    def _op_shuffle(self):
+        q=list(_queue(self.bot, self.key))
+        if len(q)<2: return False
+        random.shuffle(q); self.bot.queues[self.key]=deque(q)
+        return True
+
+    def _op_remove(self, index:int):
+        q=_queue(self.bot, self.key)
+        if index<1 or index>len(q): return None
+        removed=q[index-1]; del q[index-1]
+        return removed
+
+    def _op_clear(self):
+        _queue(self.bot, self.key).clear()
+
+    def _op_leave(self):
+        self.want="leave"
+
+def _player(bot, key:int, ctx) -> Player:
+    p=bot.players.get(key)
+    if p is None or p.closed: p=bot.players[key]=Player(bot, key, ctx)
+    return p
+
+async def _call(bot, key:int, op:str, *args):
+    """Run op on the channel's player; None if nothing was ever played there"""
+    p=bot.players.get(key)
+    return await p.call(op, *args) if p else None
+
+async def _leave(bot, key:int, vc):
+    p=bot.players.get(key)
+    if p: await p.call("leave")
+    else: await _leave_channel(bot, key, vc)
 
 # ╭─ idle worker (for empty voice channels) ─╮
-async def idle_worker():
+async def idle_worker(bot):
     await bot.wait_until_ready()
     while not bot.is_closed():
         now=datetime.now(timezone.utc)
-        for k,t in list(last_use.items()):
+        for k,t in list(bot.last_use.items()):
             vc=discord.utils.get(bot.voice_clients, channel__id=k)
-            if vc and len(vc.channel.members)<=1:
-                with contextlib.suppress(discord.DiscordException): 
-                    await vc.disconnect(force=True)
-                queues.pop(k,None); 
-                history.pop(k,None)
-                now_playing.pop(k,None)
-                last_use.pop(k,None); 
-                cancel_idle_timer(k)
-                clear_owner(k); 
-                continue
-            if (now-t).total_seconds()>VOICE_TIMEOUT:
-                with contextlib.suppress(discord.DiscordException): 
-                    await vc.disconnect(force=True)
-                queues.pop(k,None)
-                history.pop(k,None)
-                now_playing.pop(k,None)
-                last_use.pop(k,None)
-                cancel_idle_timer(k)
-                clear_owner(k)
+            if (vc and len(vc.channel.members)<=1) or (now-t).total_seconds()>VOICE_TIMEOUT:
+                bot.last_use.pop(k,None)
+                await _leave(bot,k,vc)
+                bot.log.info(f"Left channel {k}: empty or inactive for {VOICE_TIMEOUT}s")
         await asyncio.sleep(30)
 
-@bot.event
-async def on_ready():
-    if not hasattr(bot,"idle_task"): bot.idle_task=bot.loop.create_task(idle_worker())
-    log.info("Cluster %s/%s online as %s", CLUSTER_ID, TOTAL_CLUSTERS-1, bot.user)
+# ╭─ stall worker (kills FFmpeg that stopped producing audio) ─╮
+async def stall_worker(bot):
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        now=time.monotonic()
+        for vc in list(bot.voice_clients):
+            src=getattr(getattr(vc,"source",None),"original",None)
+            if not isinstance(src,SupervisedSource): continue
+            if vc.is_paused(): src.last_frame=now; continue
+            if vc.is_playing() and src.check_stall(now):
+                bot.log.warning(f"Stream stalled in channel {vc.channel.id} at {src.position:.1f}s")
+        await asyncio.sleep(5)
+
+# ╭─ index worker (keeps local search entries current) ─╮
+async def index_worker():
+    # One per process: the index is shared by every client
+    loop=asyncio.get_running_loop()
+    while True:
+        for e in track_index.stale():
+            try:
+                info=await loop.run_in_executor(extract_pool,YTDL.extract_info,e["webpage_url"],False)
+            except Exception as err:
+                if isinstance(err, yt_dlp.utils.DownloadError) and INDEX_GONE_RE.search(str(err)):
+                    log.info(f"Dropping {e['track_id']} from index: {err}")
+                    track_index.remove(e["track_id"])
+                else:
+                    log.warning(f"Failed to refresh {e['track_id']}: {err}")
+                    track_index.postpone(e["track_id"])
+                continue
+            if info: track_index.refresh(e["track_id"],info)
+        await asyncio.sleep(600)
 
 # ╭─ cluster helper ─╮
-def cluster_check(ctx): return _key(ctx)%TOTAL_CLUSTERS==CLUSTER_ID
-
-# ╭─ Commands ─╮
-@bot.command(help="Phát bài (từ khoá/link) - Hỗ trợ YouTube, SoundCloud, Spotify")
-async def play(ctx, *, query:str):
-    if not cluster_check(ctx): return
-    vc=await _ensure_vc(ctx)
-    if not vc: 
-        await ctx.reply("❌ Không join voice.")
-        return
-    
-    # Show loading message for playlists
-    loading_msg = None
-    if any(platform in query.lower() for platform in ['playlist', 'album', 'set']):
-        loading_msg = await ctx.reply("🔄 Đang tải playlist...")
-    
-    try:
-        tracks = await fetch_info(query)
-        if not tracks:
-            if loading_msg: await loading_msg.edit(content="❌ Không tìm thấy.")
-            else: await ctx.reply("❌ Không tìm thấy.")
+def cluster_check(ctx): return _key(ctx)%TOTAL_CLUSTERS==ctx.bot.cluster_id
+
+# ╭─ Commands (one cog per client) ─╮
+class Music(commands.Cog):
+    def __init__(self, bot: MyBot):
+        self.bot = bot
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        bot = self.bot
+        if not hasattr(bot,"idle_task"): bot.idle_task=bot.loop.create_task(idle_worker(bot))
+        if not hasattr(bot,"stall_task"): bot.stall_task=bot.loop.create_task(stall_worker(bot))
+        bot.log.info("Cluster %s/%s online as %s", bot.cluster_id, TOTAL_CLUSTERS-1, bot.user)
+
+    @commands.hybrid_command(help="Phát bài (từ khoá/link) - Hỗ trợ YouTube, SoundCloud, Spotify",
+                        description="Phát bài từ từ khoá hoặc link")
+    async def play(self, ctx, *, query:str):
+        # Slash commands only reach the bot they were sent to, so no cluster split there
+        if ctx.interaction is None and not cluster_check(ctx): return
+        await ctx.defer()
+        vc=await _ensure_vc(ctx)
+        if not vc: 
+            await ctx.reply("❌ Không join voice.")
             return
         
-        key=_key(ctx)
-        queue_obj = _queue(key)
-        added_count = 0
+        # Show loading message for playlists
+        loading_msg = None
+        if any(platform in query.lower() for platform in ['playlist', 'album', 'set']):
+            loading_msg = await ctx.reply("🔄 Đang tải playlist...")
         
-        for track in tracks:
-            if track:
-                queue_obj.append(track)
-                added_count += 1
+        try:
+            hit = None if loading_msg else track_index.lookup(query)
+            tracks = [hit] if hit else await fetch_info(query)
+            if not tracks:
+                if loading_msg: await loading_msg.edit(content="❌ Không tìm thấy.")
+                else: await ctx.reply("❌ Không tìm thấy.")
+                return
+            
+            key=_key(ctx)
+            tracks = [track for track in tracks if track]
+            track_index.add_many(tracks)
+            
+            set_owner(key,ctx.author.id)
+            added_count = await _player(self.bot, key, ctx).call("enqueue", tracks, ctx)
+            
+            if added_count == 1:
+                if loading_msg: 
+                    await loading_msg.edit(content=f"✅ Đã thêm **{tracks[0]['title']}**.")
+                else:
+                    await ctx.reply(f"✅ Đã thêm **{tracks[0]['title']}**.")
+            else:
+                if loading_msg:
+                    await loading_msg.edit(content=f"✅ Đã thêm {added_count} bài vào hàng chờ.")
+                else:
+                    await ctx.reply(f"✅ Đã thêm {added_count} bài vào hàng chờ.")
+                
+        except Exception as e:
+            self.bot.log.error(f"Error in play command: {e}")
+            if loading_msg: await loading_msg.edit(content="❌ Có lỗi xảy ra khi tải nhạc.")
+            else: await ctx.reply("❌ Có lỗi xảy ra khi tải nhạc.")
+
+    @play.autocomplete("query")
+    async def play_autocomplete(self, intr: discord.Interaction, current: str):
+        return [app_commands.Choice(name=f"{e['title']} — {e['uploader'] or '?'}"[:100], value=e["webpage_url"])
+                for _, e in track_index.search(current) if len(e["webpage_url"]) <= 100]
+
+    @commands.command(help="Hiển thị hàng chờ phát nhạc", aliases=["q"])
+    async def queue(self, ctx):
+        if not cluster_check(ctx): return
         
-        set_owner(key,ctx.author.id)
-        last_use[key]=datetime.now(timezone.utc)
+        key = _key(ctx)
+        queue_list = list(_queue(self.bot, key))
         
-        if added_count == 1:
-            if loading_msg: 
-                await loading_msg.edit(content=f"✅ Đã thêm **{tracks[0]['title']}**.")
-            else:
-                await ctx.reply(f"✅ Đã thêm **{tracks[0]['title']}**.")
+        if not queue_list:
+            embed = discord.Embed(
+                title="🎵 Hàng chờ phát nhạc",
+                description="Hàng chờ trống",
+                color=0x0061ff
+            )
+            await ctx.send(embed=embed)
+            return
+        
+        view = QueueView(queue_list, key)
+        await ctx.send(embed=view.get_embed(), view=view)
+
+    @commands.command(help="Bỏ qua bài")
+    async def skip(self, ctx):
+        if cluster_check(ctx) and ctx.voice_client: 
+            p = self.bot.players.get(_key(ctx))
+            if p: p.send("skip")
+            await ctx.message.add_reaction("⏭️")
+
+    @commands.command(help="Bài trước")
+    async def previous(self, ctx):
+        if not cluster_check(ctx): return
+        if not await _call(self.bot, _key(ctx), "previous"): return await ctx.reply("❌ Không có bài trước!")
+
+    @commands.command(help="Rời kênh voice")
+    async def leave(self, ctx):
+        if not cluster_check(ctx):
+            return
+        vc = ctx.voice_client
+        if vc:
+            await _leave(self.bot, _key(ctx), vc)
+            await ctx.reply("👋 Đã rời kênh.")
         else:
-            if loading_msg:
-                await loading_msg.edit(content=f"✅ Đã thêm {added_count} bài vào hàng chờ.")
+            await ctx.reply("❌ Bot không ở trong kênh.")
+
+    @commands.command(help="Tạm dừng")
+    async def pause(self, ctx):
+        if cluster_check(ctx) and await _call(self.bot, _key(ctx), "pause"):
+            await ctx.message.add_reaction("⏸️")
+
+    @commands.command(help="Tiếp tục")
+    async def resume(self, ctx):
+        if cluster_check(ctx) and await _call(self.bot, _key(ctx), "resume"):
+            await ctx.message.add_reaction("▶️")
+
+    @commands.command(help="Chỉnh âm lượng (0-200%)", aliases=["vol"])
+    async def volume(self, ctx, percent: int|None = None):
+        if not cluster_check(ctx): return
+        gid = ctx.guild.id
+        if percent is None:
+            return await ctx.reply(f"🔊 Âm lượng: {self.bot.volumes.get(gid, 1.0)*100:.0f}%")
+        if percent < 0 or percent > 200:
+            return await ctx.reply("❌ Âm lượng phải từ 0 đến 200.")
+        self.bot.volumes[gid] = percent / 100
+        vc = ctx.voice_client; info = self.bot.now_playing.get(_key(ctx))
+        if vc and info and isinstance(vc.source, discord.PCMVolumeTransformer):
+            vc.source.volume = _gain(self.bot, gid, info)
+        await ctx.reply(f"🔊 Đã chỉnh âm lượng {percent}%.")
+
+    @commands.command(help="Bật/Tắt lặp lại hàng chờ")
+    async def loop(self, ctx):
+        if not cluster_check(ctx):
+            return
+        key = _key(ctx)
+        state = await _call(self.bot, key, "loop")
+        if state is None:
+            state = self.bot.loops[key] = not self.bot.loops.get(key, False)
+        await ctx.reply("🔁 Đã bật loop." if state else "▶️ Đã tắt loop.")
+
+    @commands.command(help="Đang phát", aliases=["np"])
+    async def nowplaying(self, ctx):
+        if cluster_check(ctx): 
+            info=self.bot.now_playing.get(_key(ctx))
+            if info: 
+                await _send_np(ctx,info,_key(ctx))
             else:
-                await ctx.reply(f"✅ Đã thêm {added_count} bài vào hàng chờ.")
-        
-        if not vc.is_playing() and not vc.is_paused(): 
-            await _next(key, ctx)
-            
-    except Exception as e:
-        log.error(f"Error in play command: {e}")
-        if loading_msg: await loading_msg.edit(content="❌ Có lỗi xảy ra khi tải nhạc.")
-        else: await ctx.reply("❌ Có lỗi xảy ra khi tải nhạc.")
+                await ctx.reply("❌ Không có bài nào đang phát.")
 
-@bot.command(help="Hiển thị hàng chờ phát nhạc", aliases=["q"])
-async def queue(ctx):
-    if not cluster_check(ctx): return
-    
-    key = _key(ctx)
-    queue_list = list(_queue(key))
-    
-    if not queue_list:
+    @commands.command(name="clear", help="Xoá hàng chờ")
+    async def clearqueue(self, ctx):
+        if cluster_check(ctx):
+            await _call(self.bot, _key(ctx), "clear")
+            await ctx.reply("🗑️ Đã xoá hàng chờ.")
+
+    @commands.command(help="Trộn ngẫu nhiên hàng chờ")
+    async def shuffle(self, ctx):
+        if not cluster_check(ctx):
+            return
+        if not await _call(self.bot, _key(ctx), "shuffle"):
+            await ctx.reply("❌ Hàng chờ không đủ bài để trộn.")
+            return
+        await ctx.reply("🔀 Đã trộn hàng chờ.")
+
+    @commands.command(help="Xoá bài trong hàng chờ theo số thứ tự")
+    async def remove(self, ctx, index: int):
+        if not cluster_check(ctx):
+            return
+        removed = await _call(self.bot, _key(ctx), "remove", index)
+        if not removed:
+            await ctx.reply("❌ Số thứ tự không hợp lệ.")
+            return
+        await ctx.reply(f"🗑️ Đã xoá **{removed['title']}** khỏi hàng chờ.")
+
+    @commands.command(help="Ping")
+    async def ping(self, ctx): 
+        await ctx.reply(f"{self.bot.latency*1000:.0f} ms")
+
+    @commands.command(name="commands", help="Hiển thị danh sách lệnh")
+    async def commands_list(self, ctx):
+        if not cluster_check(ctx): return
+        
         embed = discord.Embed(
-            title="🎵 Hàng chờ phát nhạc",
-            description="Hàng chờ trống",
+            title="🎵 Danh sách lệnh",
+            description="Prefix: `" + PREFIX + "`",
             color=0x0061ff
         )
+        
+        commands_list = [
+            ("`play`, `/play` - Phát nhạc (YouTube/SoundCloud/Spotify)", "🎵"),
+            ("`queue`, `q` - Hiển thị hàng chờ", "📋"),
+            ("`nowplaying`, `np` - Bài đang phát", "▶️"),
+            ("`skip` - Bỏ qua bài", "⏭️"),
+            ("`previous` - Bài trước", "⏮️"),
+            ("`pause` - Tạm dừng", "⏸️"),
+            ("`resume` - Tiếp tục", "▶️"),
+            ("`leave` - Rời kênh voice", "👋"),
+            ("`loop` - Bật/Tắt lặp lại", "🔁"),
+            ("`volume <0-200>` - Chỉnh âm lượng", "🔊"),
+            ("`clear` - Xóa hàng chờ", "🗑️"),
+            ("`shuffle` - Trộn hàng chờ", "🔀"),
+            ("`remove <số>` - Xóa bài khỏi hàng chờ", "❌"),
+            ("`ping` - Kiểm tra độ trễ", "🏓"),
+            ("`commands` - Hiển thị lệnh này", "📝")
+        ]
+        
+        for cmd, emoji in commands_list:
+            embed.add_field(name=f"{emoji} {cmd.split(' - ')[0]}", value=cmd.split(' - ')[1], inline=True)
+        
+        embed.add_field(
+            name="ℹ️ Lưu ý", 
+            value="• Bot tự động rời kênh sau 1 phút không phát nhạc\n• Hỗ trợ playlist từ tất cả 3 nền tảng\n• Hàng chờ hiển thị 15 bài/trang", 
+            inline=False
+        )
+        
         await ctx.send(embed=embed)
-        return
-    
-    view = QueueView(queue_list, key)
-    await ctx.send(embed=view.get_embed(), view=view)
-
-@bot.command(help="Bỏ qua bài")
-async def skip(ctx):
-    if cluster_check(ctx) and ctx.voice_client: 
-        ctx.voice_client.stop(); 
-        await ctx.message.add_reaction("⏭️")
-
-@bot.command(help="Bài trước")
-async def previous(ctx):
-    if not cluster_check(ctx): return
-    key=_key(ctx); hist=_history(key)
-    if not hist: return await ctx.reply("❌ Không có bài trước!")
-    _queue(key).appendleft(hist.pop()); 
-    if ctx.voice_client: ctx.voice_client.stop()
-
-@bot.command(help="Rời kênh voice")
-async def leave(ctx):
-    if not cluster_check(ctx):
-        return
-    vc = ctx.voice_client
-    if vc:
-        await vc.disconnect(force=True)
-        key = _key(ctx)
-        queues.pop(key, None)
-        history.pop(key, None)
-        now_playing.pop(key, None)
-        last_use.pop(key, None)
-        cancel_idle_timer(key)
-        clear_owner(key)
-        await ctx.reply("👋 Đã rời kênh.")
-    else:
-        await ctx.reply("❌ Bot không ở trong kênh.")
-
-@bot.command(help="Tạm dừng")
-async def pause(ctx):
-    if cluster_check(ctx) and ctx.voice_client and ctx.voice_client.is_playing():
-        ctx.voice_client.pause(); 
-        start_idle_timer(_key(ctx))
-        await ctx.message.add_reaction("⏸️")
-
-@bot.command(help="Tiếp tục")
-async def resume(ctx):
-    if cluster_check(ctx) and ctx.voice_client and ctx.voice_client.is_paused():
-        ctx.voice_client.resume(); 
-        cancel_idle_timer(_key(ctx))
-        await ctx.message.add_reaction("▶️")
-
-@bot.command(help="Bật/Tắt lặp lại hàng chờ")
-async def loop(ctx):
-    if not cluster_check(ctx):
-        return
-    key = _key(ctx)
-    state = loops.get(key, False)
-    loops[key] = not state
-    if loops[key]:
-        current = now_playing.get(key)
-        if current and current not in _queue(key):
-            _queue(key).appendleft(current)
-    await ctx.reply("🔁 Đã bật loop." if loops[key] else "▶️ Đã tắt loop.")
-
-@bot.command(help="Đang phát", aliases=["np"])
-async def nowplaying(ctx):
-    if cluster_check(ctx): 
-        info=now_playing.get(_key(ctx))
-        if info: 
-            await _send_np(ctx,info,_key(ctx))
-        else:
-            await ctx.reply("❌ Không có bài nào đang phát.")
-
-@bot.command(name="clear", help="Xoá hàng chờ")
-async def clearqueue(ctx):
-    if cluster_check(ctx):
-        key = _key(ctx)
-        _queue(key).clear()
-        await ctx.reply("🗑️ Đã xoá hàng chờ.")
-
-@bot.command(help="Trộn ngẫu nhiên hàng chờ")
-async def shuffle(ctx):
-    if not cluster_check(ctx):
-        return
-    key = _key(ctx)
-    q = list(_queue(key))
-    if len(q) < 2:
-        await ctx.reply("❌ Hàng chờ không đủ bài để trộn.")
-        return
-    random.shuffle(q)
-    queues[key] = deque(q)
-    await ctx.reply("🔀 Đã trộn hàng chờ.")
-
-@bot.command(help="Xoá bài trong hàng chờ theo số thứ tự")
-async def remove(ctx, index: int):
-    if not cluster_check(ctx):
-        return
-    key = _key(ctx)
-    q = list(_queue(key))
-    if index < 1 or index > len(q):
-        await ctx.reply("❌ Số thứ tự không hợp lệ.")
-        return
-    removed = q.pop(index - 1)
-    queues[key] = deque(q)
-    await ctx.reply(f"🗑️ Đã xoá **{removed['title']}** khỏi hàng chờ.")
-
-@bot.command(help="Ping")
-async def ping(ctx): 
-    await ctx.reply(f"{bot.latency*1000:.0f} ms")
-
-@bot.command(name="commands", help="Hiển thị danh sách lệnh")
-async def commands_list(ctx):
-    if not cluster_check(ctx): return
-    
-    embed = discord.Embed(
-        title="🎵 Danh sách lệnh",
-        description="Prefix: `" + PREFIX + "`",
-        color=0x0061ff
-    )
-    
-    commands_list = [
-        ("`play` - Phát nhạc (YouTube/SoundCloud/Spotify)", "🎵"),
-        ("`queue`, `q` - Hiển thị hàng chờ", "📋"),
-        ("`nowplaying`, `np` - Bài đang phát", "▶️"),
-        ("`skip` - Bỏ qua bài", "⏭️"),
-        ("`previous` - Bài trước", "⏮️"),
-        ("`pause` - Tạm dừng", "⏸️"),
-        ("`resume` - Tiếp tục", "▶️"),
-        ("`leave` - Rời kênh voice", "👋"),
-        ("`loop` - Bật/Tắt lặp lại", "🔁"),
-        ("`clear` - Xóa hàng chờ", "🗑️"),
-        ("`shuffle` - Trộn hàng chờ", "🔀"),
-        ("`remove <số>` - Xóa bài khỏi hàng chờ", "❌"),
-        ("`ping` - Kiểm tra độ trễ", "🏓"),
-        ("`commands` - Hiển thị lệnh này", "📝")
-    ]
-    
-    for cmd, emoji in commands_list:
-        embed.add_field(name=f"{emoji} {cmd.split(' - ')[0]}", value=cmd.split(' - ')[1], inline=True)
-    
-    embed.add_field(
-        name="ℹ️ Lưu ý", 
-        value="• Bot tự động rời kênh sau 1 phút không phát nhạc\n• Hỗ trợ playlist từ tất cả 3 nền tảng\n• Hàng chờ hiển thị 15 bài/trang", 
-        inline=False
-    )
-    
-    await ctx.send(embed=embed)
 
 # ╭─ RUN ─╮
+async def _run_client(bot: MyBot):
+    # A bad or revoked token only takes down its own client, not the rest of the process
+    try:
+        await bot.start(BOT_TOKENS[bot.cluster_id], reconnect=True)
+    except Exception as e:
+        bot.log.error(f"Client stopped: {e!r}")
+    finally:
+        await bot.close()
+
+async def run_clients():
+    """Host every cluster in CLUSTER_IDS on one loop, sharing extraction, caches and bot.db"""
+    bots=[MyBot(cid, command_prefix=PREFIX, intents=intents) for cid in CLUSTER_IDS]
+    index_task=asyncio.create_task(index_worker())
+    try:
+        await asyncio.gather(*(_run_client(b) for b in bots))
+    finally:
+        index_task.cancel()
+        await asyncio.gather(*(b.close() for b in bots), return_exceptions=True)
+
 if __name__=="__main__":
-    bot.run(TOKEN, reconnect=True)
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(run_clients())